@@ -1,6 +1,16 @@
+import copy
 import struct
 import json
+import sys
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
 from io import BytesIO
+from itertools import chain
+
+# Bits of every byte value, least significant first, for unpacking bitmaps
+_BIT_TABLE = [tuple(bool(b >> i & 1) for i in range(8)) for b in range(256)]
+_SCALAR_TYPES = {type(None), bool, int, float, str}
 
 class CBD:
     # Type codes (3-bit, padded to 1 byte with container flag and value bits)
@@ -10,6 +20,29 @@ class CBD:
     TYPE_STRING = 3 << 5  # 011xxxxx
     TYPE_ARRAY = 4 << 5 | 1  # 10000001 (container)
     TYPE_OBJECT = 5 << 5 | 1  # 10100001 (container)
+    TYPE_SHARED = 6 << 5  # 11000000 (next value may be back-referenced)
+    TYPE_REF = 6 << 5 | 2  # 11000010 (back-reference to a shared value)
+    TYPE_PACKED = 7 << 5 | 1  # 111cccc1 (scalar array, codec in bits 4-1)
+    
+    # Packed array codecs
+    PACK_NULLS = 0  # all null: length only
+    PACK_BOOLS = 1  # all boolean: bitmap
+    PACK_OPTIONAL_BOOLS = 2  # booleans and nulls: presence bitmap, value bitmap
+    PACK_RLE = 3  # runs of repeated scalars
+    PACK_DELTA = 4  # non-negative integers as zigzag varint deltas
+    MIN_PACKED_LENGTH = 4
+    
+    # Header
+    FORMAT_VERSION = 0x02
+    FLAG_KEY_INDEX = 0x01  # dictionary is preceded by an offset table and hash index
+    FLAG_CHECKSUM = 0x02  # CRC32 of header and dictionary, and of each data block
+    CHECKSUM_BLOCK_SIZE = 64 * 1024
+    
+    # Patch operations produced by diff()
+    PATCH_MAGIC = 0xCBDF
+    OP_SET = 0  # [0, path, value]
+    OP_DELETE = 1  # [1, path]
+    OP_SPLICE = 2  # [2, path, start, delete_count, items]
     
     @staticmethod
     def _encode_varint(n):
@@ -38,46 +71,320 @@ class CBD:
         return n, pos
     
     @staticmethod
-    def serialize(data):
-        """Serialize data to CBD binary format."""
+    def _decode_varint_checked(buffer, pos, end):
+        """Decode a varint like ``_decode_varint``, rejecting truncated or over-long (> 64-bit) values."""
+        n = 0
+        shift = 0
+        while True:
+            if pos >= end:
+                raise ValueError("Truncated varint")
+            b = buffer[pos]
+            pos += 1
+            n |= (b & 127) << shift
+            if not (b & 128):
+                break
+            shift += 7
+            if shift > 63:
+                raise ValueError("Varint exceeds 64 bits")
+        return n, pos
+    
+    @staticmethod
+    def _encode_scalar(val):
+        """Encode a null, boolean, number or string value."""
+        if val is None:
+            return struct.pack("B", CBD.TYPE_NULL)
+        elif isinstance(val, bool):
+            return struct.pack("B", CBD.TYPE_BOOL | int(val))
+        elif isinstance(val, (int, float)):
+            return struct.pack("B", CBD.TYPE_NUMBER) + CBD._encode_varint(int(val))
+        elif isinstance(val, str):
+            val_bytes = val.encode('utf-8')
+            return struct.pack("B", CBD.TYPE_STRING) + CBD._encode_varint(len(val_bytes)) + val_bytes
+        else:
+            raise ValueError(f"Unsupported type: {type(val)}")
+    
+    @staticmethod
+    def _pack_bits(bits, length):
+        """Pack an iterable of truth values into a bitmap, least significant bit first."""
+        out = bytearray((length + 7) // 8)
+        for i, bit in enumerate(bits):
+            if bit:
+                out[i >> 3] |= 1 << (i & 7)
+        return bytes(out)
+    
+    @staticmethod
+    def _unpack_bits(buffer, pos, length):
+        """Unpack ``length`` booleans from the bitmap at ``pos``."""
+        bits = list(chain.from_iterable(map(_BIT_TABLE.__getitem__, buffer[pos:pos + (length + 7) // 8])))
+        del bits[length:]
+        return bits
+    
+    @staticmethod
+    def _encode_scalar_array(val):
+        """Encode an array of scalars with the smallest codec, or return None if it holds containers.
+        
+        Boolean and null arrays become bitmaps. Other scalar arrays use
+        run-length or delta encoding when that is smaller than the plain
+        element-by-element encoding.
+        """
+        types = set(map(type, val))
+        if not types <= _SCALAR_TYPES:
+            return None
+        length = len(val)
+        header = CBD._encode_varint(length)
+        
+        if types <= {bool, type(None)}:
+            if bool not in types:
+                return struct.pack("B", CBD.TYPE_PACKED | CBD.PACK_NULLS << 1) + header
+            values = CBD._pack_bits(val, length)
+            if type(None) not in types:
+                return struct.pack("B", CBD.TYPE_PACKED | CBD.PACK_BOOLS << 1) + header + values
+            presence = CBD._pack_bits((v is not None for v in val), length)
+            return struct.pack("B", CBD.TYPE_PACKED | CBD.PACK_OPTIONAL_BOOLS << 1) + header + presence + values
+        
+        encoded = [CBD._encode_scalar(v) for v in val]
+        best = struct.pack("B", CBD.TYPE_ARRAY) + header + b''.join(encoded)
+        
+        # Runs of identical encodings
+        runs = []
+        for item in encoded:
+            if runs and runs[-1][0] == item:
+                runs[-1][1] += 1
+            else:
+                runs.append([item, 1])
+        if len(runs) <= length // 2:
+            parts = [struct.pack("B", CBD.TYPE_PACKED | CBD.PACK_RLE << 1), header, CBD._encode_varint(len(runs))]
+            for item, count in runs:
+                parts.append(CBD._encode_varint(count))
+                parts.append(item)
+            rle = b''.join(parts)
+            if len(rle) < len(best):
+                best = rle
+        
+        # Zigzag deltas, for sorted or slowly changing integers
+        if types == {int}:
+            parts = [struct.pack("B", CBD.TYPE_PACKED | CBD.PACK_DELTA << 1), header]
+            prev = 0
+            for v in val:
+                delta = v - prev
+                parts.append(CBD._encode_varint(delta * 2 if delta >= 0 else -delta * 2 - 1))
+                prev = v
+            delta = b''.join(parts)
+            if len(delta) < len(best):
+                best = delta
+        
+        return best
+    
+    @staticmethod
+    def serialize(data, dedup=False, cache=None, key_index=False, checksum=False):
+        """Serialize data to CBD binary format.
+        
+        With ``dedup=True`` identical arrays and objects are written once and
+        repeated copies become back-references. ``cache`` is an optional
+        ``EncodeCache`` that keeps encoded sub-objects across calls.
+        ``key_index=True`` adds an offset table and hash index to the
+        dictionary so decoders can look keys up without reading all of them.
+        ``checksum=True`` adds CRC32 checksums that decoders verify.
+        """
+        if dedup or cache is not None:
+            return CBD._serialize_fragments(data, dedup, cache, key_index, checksum)
+        
         buffer = BytesIO()
         
-        # Header: Magic (0xCBD1), Version (0x01), Dictionary Size
-        keys = []
-        def collect_keys(obj):
+        # Header and dictionary
+        keys = CBD._collect_keys(data)
+        CBD._write_header(buffer, keys, key_index, checksum)
+        data_start = buffer.tell()
+        
+        # Data
+        key_ids = {k: i + 1 for i, k in enumerate(keys)}
+        CBD._write_value(buffer, data, key_ids)
+        if checksum:
+            return CBD._add_checksums(buffer.getvalue(), data_start)
+        return buffer.getvalue()
+    
+    @staticmethod
+    def _collect_keys(data):
+        """Return the distinct object keys in ``data`` in dictionary order."""
+        counts = {}
+        def count_keys(obj):
             if isinstance(obj, dict):
                 for k, v in obj.items():
-                    if k not in keys:
-                        keys.append(k)
-                    collect_keys(v)
-            elif isinstance(obj, list):
+                    counts[k] = counts.get(k, 0) + 1
+                    if isinstance(v, (dict, list)):
+                        count_keys(v)
+            else:
                 for v in obj:
-                    collect_keys(v)
-        collect_keys(data)
+                    if isinstance(v, (dict, list)):
+                        count_keys(v)
+        if isinstance(data, (dict, list)):
+            count_keys(data)
+        return CBD._order_keys(counts)
+    
+    @staticmethod
+    def _order_keys(counts):
+        """Order keys by descending frequency, ties in first-seen order.
         
-        buffer.write(struct.pack(">HBB", 0xCBD1, 0x01, len(keys)))
+        The most used keys get the smallest IDs, which encode as 1-byte
+        varints up to 127.
+        """
+        return sorted(counts, key=counts.__getitem__, reverse=True)
+    
+    @staticmethod
+    def _index_slots(count):
+        """Number of hash index slots for a dictionary of ``count`` keys (a power of two)."""
+        return 1 << max(2 * count - 1, 1).bit_length()
+    
+    @staticmethod
+    def _write_header(buffer, keys, key_index=False, checksum=False):
+        """Write the header and dictionary sections."""
+        # Header: Magic (0xCBD1), Version (0x02), Flags, Dictionary Size
+        flags = (CBD.FLAG_KEY_INDEX if key_index else 0) | (CBD.FLAG_CHECKSUM if checksum else 0)
+        buffer.write(struct.pack(">HBB", 0xCBD1, CBD.FORMAT_VERSION, flags))
+        buffer.write(CBD._encode_varint(len(keys)))
+        if not key_index:
+            CBD._write_keys(buffer, keys)
+            return
         
-        # Dictionary: length-prefixed strings
+        # Offset of each dictionary entry (plus the end), then a linear
+        # probing hash table of 1-based key IDs, then the entries themselves
+        encoded = [key.encode('utf-8') for key in keys]
+        entries = [CBD._encode_varint(len(key_bytes)) + key_bytes for key_bytes in encoded]
+        offsets = [0]
+        for entry in entries:
+            offsets.append(offsets[-1] + len(entry))
+        slots = CBD._index_slots(len(keys))
+        table = [0] * slots
+        for key_id, key_bytes in enumerate(encoded, 1):
+            slot = zlib.crc32(key_bytes) & (slots - 1)
+            while table[slot]:
+                slot = (slot + 1) & (slots - 1)
+            table[slot] = key_id
+        buffer.write(struct.pack(f">{len(offsets)}I", *offsets))
+        buffer.write(struct.pack(f">{slots}I", *table))
+        buffer.write(b''.join(entries))
+    
+    @staticmethod
+    def _read_header(buffer, dictionaries=None, verify=True):
+        """Read the header and dictionary, returning the keys, flags and data position.
+        
+        ``dictionaries`` is an optional ``OrderedDict`` mapping encoded
+        dictionaries to their keys, least recently used first; a dictionary
+        found there is compared in place rather than decoded again. With
+        ``verify=False`` the position of the checksum section is returned
+        without checking it.
+        """
+        magic, version = struct.unpack_from(">HB", buffer, 0)
+        if magic != 0xCBD1:
+            raise ValueError("Invalid CBD format or version")
+        if version == 0x01:
+            # Original layout: one-byte dictionary size, no flags
+            flags, dict_size, pos = 0, buffer[3], 4
+        elif version == CBD.FORMAT_VERSION:
+            flags = buffer[3]
+            dict_size, pos = CBD._decode_varint(buffer, 4)
+        else:
+            raise ValueError("Invalid CBD format or version")
+        if flags & CBD.FLAG_KEY_INDEX:
+            keys = KeyIndex(buffer, pos, dict_size)
+            pos = keys.end
+        elif dictionaries is not None:
+            # Most recently used first; equal bytes always parse to the same keys
+            keys = None
+            for encoded, cached in reversed(dictionaries.items()):
+                if len(cached) != dict_size:
+                    continue
+                if isinstance(buffer, (bytes, bytearray)):
+                    found = buffer.startswith(encoded, pos)
+                else:
+                    found = len(buffer) - pos >= len(encoded) and encoded.startswith(buffer[pos:pos + len(encoded)])
+                if found:
+                    keys = cached
+                    dictionaries.move_to_end(encoded)
+                    pos += len(encoded)
+                    break
+            if keys is None:
+                start = pos
+                keys, pos = CBD._read_keys(buffer, pos, dict_size)
+                dictionaries[bytes(buffer[start:pos])] = keys
+        else:
+            keys, pos = CBD._read_keys(buffer, pos, dict_size)
+        if verify and flags & CBD.FLAG_CHECKSUM:
+            pos, _ = CBD._verify_checksums(buffer, pos)
+        return keys, flags, pos
+    
+    @staticmethod
+    def _add_checksums(encoded, data_start):
+        """Insert the checksum section into an encoded document whose data starts at ``data_start``.
+        
+        The header and dictionary are followed by their CRC32, the data
+        length and the block size; the data is followed by the CRC32 of each
+        block.
+        """
+        view = memoryview(encoded)
+        data = view[data_start:]
+        block = CBD.CHECKSUM_BLOCK_SIZE
+        parts = [
+            view[:data_start],
+            struct.pack(">I", zlib.crc32(view[:data_start])),
+            CBD._encode_varint(len(data)),
+            CBD._encode_varint(block),
+            data,
+        ]
+        parts.extend(struct.pack(">I", zlib.crc32(data[i:i + block])) for i in range(0, len(data), block))
+        return b''.join(parts)
+    
+    @staticmethod
+    def _verify_checksums(buffer, pos):
+        """Verify the checksum section at ``pos``, returning the start and end of the data."""
+        view = memoryview(buffer)
+        if pos + 4 > len(view):
+            raise ValueError("Truncated checksum section")
+        if struct.unpack_from(">I", view, pos)[0] != zlib.crc32(view[:pos]):
+            raise ValueError("Header checksum mismatch")
+        data_len, pos = CBD._decode_varint_checked(view, pos + 4, len(view))
+        block, pos = CBD._decode_varint_checked(view, pos, len(view))
+        if block == 0:
+            raise ValueError("Invalid checksum block size")
+        end = pos + data_len
+        blocks = (data_len + block - 1) // block
+        if end + 4 * blocks != len(view):
+            raise ValueError("Data length does not match checksum section")
+        for i in range(blocks):
+            start = pos + i * block
+            expected = struct.unpack_from(">I", view, end + 4 * i)[0]
+            if zlib.crc32(view[start:min(start + block, end)]) != expected:
+                raise ValueError(f"Checksum mismatch in data block {i}")
+        return pos, end
+    
+    @staticmethod
+    def _write_keys(buffer, keys):
+        """Write dictionary keys as length-prefixed UTF-8 strings."""
         for key in keys:
             key_bytes = key.encode('utf-8')
             buffer.write(CBD._encode_varint(len(key_bytes)))
             buffer.write(key_bytes)
-        
-        # Data
+    
+    @staticmethod
+    def _read_keys(buffer, pos, count):
+        """Read ``count`` dictionary keys at ``pos``, returning them with the new position."""
+        keys = []
+        for _ in range(count):
+            length, pos = CBD._decode_varint(buffer, pos)
+            key = str(buffer[pos:pos+length], 'utf-8')
+            keys.append(key)
+            pos += length
+        return keys, pos
+    
+    @staticmethod
+    def _write_value(buffer, data, key_ids):
+        """Write ``data`` to ``buffer``, mapping object keys through ``key_ids``."""
         def serialize_value(val):
-            if val is None:
-                buffer.write(struct.pack("B", CBD.TYPE_NULL))
-            elif isinstance(val, bool):
-                buffer.write(struct.pack("B", CBD.TYPE_BOOL | int(val)))
-            elif isinstance(val, (int, float)):
-                buffer.write(struct.pack("B", CBD.TYPE_NUMBER))
-                buffer.write(CBD._encode_varint(int(val)))
-            elif isinstance(val, str):
-                val_bytes = val.encode('utf-8')
-                buffer.write(struct.pack("B", CBD.TYPE_STRING))
-                buffer.write(CBD._encode_varint(len(val_bytes)))
-                buffer.write(val_bytes)
-            elif isinstance(val, list):
+            if isinstance(val, list):
+                packed = CBD._encode_scalar_array(val) if len(val) >= CBD.MIN_PACKED_LENGTH else None
+                if packed is not None:
+                    buffer.write(packed)
+                    return
                 buffer.write(struct.pack("B", CBD.TYPE_ARRAY))
                 buffer.write(CBD._encode_varint(len(val)))
                 for item in val:
@@ -86,36 +393,175 @@ class CBD:
                 buffer.write(struct.pack("B", CBD.TYPE_OBJECT))
                 buffer.write(CBD._encode_varint(len(val)))
                 for k, v in val.items():
-                    buffer.write(CBD._encode_varint(keys.index(k) + 1))
+                    buffer.write(CBD._encode_varint(key_ids[k]))
                     serialize_value(v)
             else:
-                raise ValueError(f"Unsupported type: {type(val)}")
+                buffer.write(CBD._encode_scalar(val))
         
         serialize_value(data)
+    
+    @staticmethod
+    def _serialize_fragments(data, dedup, cache, key_index=False, checksum=False):
+        """Serialize by encoding every container to its own byte fragment.
+        
+        Fragments double as content fingerprints: two subtrees are identical
+        exactly when their encodings are. Fragments are memoized by object
+        identity within the call, and by ``cache`` across calls. Subtrees
+        served from the cache are treated as opaque, so only the subtree as a
+        whole can be deduplicated.
+        """
+        # Dictionary; cached subtrees contribute their recorded key counts
+        # without being walked
+        counts = {}
+        def collect_keys(obj):
+            if isinstance(obj, (list, dict)):
+                entry = cache.get(obj) if cache is not None else None
+                if entry is not None:
+                    for k, c in entry[1].items():
+                        counts[k] = counts.get(k, 0) + c
+                elif isinstance(obj, dict):
+                    for k, v in obj.items():
+                        counts[k] = counts.get(k, 0) + 1
+                        collect_keys(v)
+                else:
+                    for v in obj:
+                        collect_keys(v)
+        collect_keys(data)
+        keys = CBD._order_keys(counts)
+        key_ids = {k: i + 1 for i, k in enumerate(keys)}
+        
+        frags = {}  # id(container) -> encoded bytes
+        subtree_keys = {}  # id(container) -> key counts, only tracked for the cache
+        opaque = set()  # ids of containers served from the cache
+        
+        def fragment(val):
+            if not isinstance(val, (list, dict)):
+                return CBD._encode_scalar(val)
+            frag = frags.get(id(val))
+            if frag is not None:
+                return frag
+            if cache is not None:
+                entry = cache.get(val)
+                if entry is not None and entry[2] == tuple(key_ids[k] for k in entry[1]):
+                    frags[id(val)] = entry[3]
+                    subtree_keys[id(val)] = entry[1]
+                    opaque.add(id(val))
+                    return entry[3]
+            packed = None
+            if isinstance(val, list) and len(val) >= CBD.MIN_PACKED_LENGTH:
+                packed = CBD._encode_scalar_array(val)
+            if packed is not None:
+                parts = [packed]
+            elif isinstance(val, list):
+                parts = [struct.pack("B", CBD.TYPE_ARRAY), CBD._encode_varint(len(val))]
+                parts.extend(fragment(item) for item in val)
+            else:
+                parts = [struct.pack("B", CBD.TYPE_OBJECT), CBD._encode_varint(len(val))]
+                for k, v in val.items():
+                    parts.append(CBD._encode_varint(key_ids[k]))
+                    parts.append(fragment(v))
+            frag = b''.join(parts)
+            frags[id(val)] = frag
+            if cache is not None:
+                # Key occurrence counts of the subtree
+                sub_counts = {}
+                for k, v in (val.items() if isinstance(val, dict) else enumerate(val)):
+                    if isinstance(val, dict):
+                        sub_counts[k] = sub_counts.get(k, 0) + 1
+                    if isinstance(v, (list, dict)):
+                        for ck, c in subtree_keys[id(v)].items():
+                            sub_counts[ck] = sub_counts.get(ck, 0) + c
+                subtree_keys[id(val)] = sub_counts
+                cache.put(val, sub_counts, tuple(key_ids[k] for k in sub_counts), frag)
+            return frag
+        
+        body = fragment(data)
+        
+        if dedup:
+            # Count repeats top-down; children of a repeat are only counted
+            # under its first occurrence, since later copies become references
+            counts = {}
+            def count(val):
+                if isinstance(val, (list, dict)) and val:
+                    frag = frags[id(val)]
+                    counts[frag] = counts.get(frag, 0) + 1
+                    if counts[frag] == 1 and id(val) not in opaque:
+                        for child in (val if isinstance(val, list) else val.values()):
+                            count(child)
+            count(data)
+            
+            out = []
+            defined = {}
+            def emit(val):
+                if not isinstance(val, (list, dict)):
+                    out.append(CBD._encode_scalar(val))
+                    return
+                frag = frags[id(val)]
+                if val and counts[frag] > 1:
+                    ref = defined.get(frag)
+                    if ref is not None:
+                        out.append(struct.pack("B", CBD.TYPE_REF))
+                        out.append(CBD._encode_varint(ref))
+                        return
+                    defined[frag] = len(defined)
+                    out.append(struct.pack("B", CBD.TYPE_SHARED))
+                if id(val) in opaque or frag[0] >> 5 == CBD.TYPE_PACKED >> 5:
+                    out.append(frag)
+                elif isinstance(val, list):
+                    out.append(struct.pack("B", CBD.TYPE_ARRAY))
+                    out.append(CBD._encode_varint(len(val)))
+                    for item in val:
+                        emit(item)
+                else:
+                    out.append(struct.pack("B", CBD.TYPE_OBJECT))
+                    out.append(CBD._encode_varint(len(val)))
+                    for k, v in val.items():
+                        out.append(CBD._encode_varint(key_ids[k]))
+                        emit(v)
+            emit(data)
+            body = b''.join(out)
+        
+        buffer = BytesIO()
+        CBD._write_header(buffer, keys, key_index, checksum)
+        data_start = buffer.tell()
+        buffer.write(body)
+        if checksum:
+            return CBD._add_checksums(buffer.getvalue(), data_start)
         return buffer.getvalue()
     
     @staticmethod
-    def deserialize(binary):
-        """Deserialize CBD binary data to Python object."""
+    def deserialize(binary, shared=False):
+        """Deserialize CBD binary data to Python object.
+        
+        ``binary`` may be any bytes-like object; a memoryview is decoded in
+        place without copying it.
+        
+        Back-references produced by ``serialize(..., dedup=True)`` decode to
+        independent copies, or with ``shared=True`` to the same object.
+        """
         buffer = binary
-        pos = 0
         
-        # Read header
-        magic, version, dict_size = struct.unpack_from(">HBB", buffer, pos)
-        pos += 4
-        if magic != 0xCBD1 or version != 0x01:
-            raise ValueError("Invalid CBD format or version")
+        # Read header and dictionary
+        keys, flags, pos = CBD._read_header(buffer)
         
-        # Read dictionary
-        keys = []
-        for _ in range(dict_size):
-            length, pos = CBD._decode_varint(buffer, pos)
-            key = buffer[pos:pos+length].decode('utf-8')
-            keys.append(key)
-            pos += length
+        return CBD._read_value(buffer, pos, keys, shared)[0]
+    
+    @staticmethod
+    def _read_value(buffer, pos, keys, shared=False, refs=None):
+        """Decode one value at ``pos``, returning it with the position after it.
+        
+        ``refs`` supplies the offsets of all shared values up front, for
+        decoding part of a document; shared values are then always copied.
+        """
+        if refs is None:
+            refs = []  # (offset, value) of each shared value, in definition order
+            replaying = 0  # > 0 while re-decoding a shared value to copy it
+        else:
+            shared = False
+            replaying = 1
         
         def deserialize_value():
-            nonlocal pos
+            nonlocal pos, replaying
             type_byte = buffer[pos]
             pos += 1
             type_code = type_byte >> 5
@@ -131,7 +577,7 @@ class CBD:
             elif type_code == 3:  # String
                 length, pos2 = CBD._decode_varint(buffer, pos)
                 pos = pos2
-                val = buffer[pos:pos+length].decode('utf-8')
+                val = str(buffer[pos:pos+length], 'utf-8')
                 pos += length
                 return val
             elif type_code == 4:  # Array
@@ -147,10 +593,1080 @@ class CBD:
                     pos = pos2
                     obj[keys[key_idx-1]] = deserialize_value()
                 return obj
+            elif type_code == 6:  # Shared value or back-reference
+                if type_byte & 2:
+                    ref_idx, pos2 = CBD._decode_varint(buffer, pos)
+                    offset, val = refs[ref_idx]
+                    if shared:
+                        pos = pos2
+                        return val
+                    # Decode the shared value again for an independent copy
+                    pos = offset
+                    replaying += 1
+                    val = deserialize_value()
+                    replaying -= 1
+                    pos = pos2
+                    return val
+                if replaying:
+                    return deserialize_value()
+                ref_idx = len(refs)
+                refs.append(None)
+                offset = pos
+                refs[ref_idx] = (offset, deserialize_value())
+                return refs[ref_idx][1]
+            elif type_code == 7:  # Packed scalar array
+                length, pos2 = CBD._decode_varint(buffer, pos)
+                pos = pos2
+                codec = (type_byte >> 1) & 15
+                if codec == CBD.PACK_NULLS:
+                    return [None] * length
+                elif codec == CBD.PACK_BOOLS:
+                    val = CBD._unpack_bits(buffer, pos, length)
+                    pos += (length + 7) // 8
+                    return val
+                elif codec == CBD.PACK_OPTIONAL_BOOLS:
+                    size = (length + 7) // 8
+                    presence = CBD._unpack_bits(buffer, pos, length)
+                    values = CBD._unpack_bits(buffer, pos + size, length)
+                    pos += 2 * size
+                    return [v if p else None for p, v in zip(presence, values)]
+                elif codec == CBD.PACK_RLE:
+                    runs, pos2 = CBD._decode_varint(buffer, pos)
+                    pos = pos2
+                    val = []
+                    for _ in range(runs):
+                        count, pos2 = CBD._decode_varint(buffer, pos)
+                        pos = pos2
+                        val.extend([deserialize_value()] * count)
+                    return val
+                elif codec == CBD.PACK_DELTA:
+                    val = []
+                    prev = 0
+                    for _ in range(length):
+                        zigzag, pos = CBD._decode_varint(buffer, pos)
+                        prev += (zigzag >> 1) ^ -(zigzag & 1)
+                        val.append(prev)
+                    return val
+                else:
+                    raise ValueError(f"Unknown array codec: {codec}")
             else:
                 raise ValueError(f"Unknown type code: {type_code}")
         
-        return deserialize_value()
+        try:
+            return deserialize_value(), pos
+        finally:
+            # deserialize_value refers to itself; break the cycle so the
+            # buffer, which may be shared memory, is released straight away
+            del deserialize_value
+    
+    @staticmethod
+    def _skip_value(buffer, pos, shared=None):
+        """Return the position after the value at ``pos`` without decoding it.
+        
+        The offsets of shared values met on the way are appended to ``shared``.
+        """
+        type_byte = buffer[pos]
+        pos += 1
+        type_code = type_byte >> 5
+        if type_code <= 1:  # Null, Boolean
+            return pos
+        elif type_code == 2:  # Number
+            return CBD._decode_varint(buffer, pos)[1]
+        elif type_code == 3:  # String
+            length, pos = CBD._decode_varint(buffer, pos)
+            return pos + length
+        elif type_code == 4:  # Array
+            length, pos = CBD._decode_varint(buffer, pos)
+            for _ in range(length):
+                pos = CBD._skip_value(buffer, pos, shared)
+            return pos
+        elif type_code == 5:  # Object
+            length, pos = CBD._decode_varint(buffer, pos)
+            for _ in range(length):
+                pos = CBD._decode_varint(buffer, pos)[1]
+                pos = CBD._skip_value(buffer, pos, shared)
+            return pos
+        elif type_code == 6:  # Shared value or back-reference
+            if type_byte & 2:
+                return CBD._decode_varint(buffer, pos)[1]
+            if shared is not None:
+                shared.append((pos, None))
+            return CBD._skip_value(buffer, pos, shared)
+        elif type_code == 7:  # Packed scalar array
+            length, pos = CBD._decode_varint(buffer, pos)
+            codec = (type_byte >> 1) & 15
+            if codec == CBD.PACK_BOOLS:
+                return pos + (length + 7) // 8
+            elif codec == CBD.PACK_OPTIONAL_BOOLS:
+                return pos + 2 * ((length + 7) // 8)
+            elif codec == CBD.PACK_RLE:
+                runs, pos = CBD._decode_varint(buffer, pos)
+                for _ in range(runs):
+                    pos = CBD._decode_varint(buffer, pos)[1]
+                    pos = CBD._skip_value(buffer, pos)
+            elif codec == CBD.PACK_DELTA:
+                for _ in range(length):
+                    pos = CBD._decode_varint(buffer, pos)[1]
+            return pos
+    
+    @staticmethod
+    def view(buffer):
+        """Open a lazy, read-only view of an encoded document.
+        
+        Arrays and objects are returned as ``CBDView`` objects that only
+        decode the elements that are accessed; scalar roots are decoded
+        directly. The buffer must not change while views are in use.
+        """
+        keys, flags, pos = CBD._read_header(buffer)
+        return _ViewDocument(buffer, keys).value_at(pos)
+    
+    @staticmethod
+    def validate(buffer, check_utf8=False, max_depth=None, max_length=None, max_size=None, max_elements=None):
+        """Check that ``buffer`` is a well-formed CBD document without decoding it.
+        
+        Walks the encoding without building any values, checking type bytes,
+        varint bounds, dictionary indices, back-references, checksums (if
+        present) and that the data ends exactly at the end of the buffer.
+        ``check_utf8`` also verifies that keys and strings are valid UTF-8.
+        ``max_depth`` limits container nesting, ``max_length`` the element
+        count of arrays, objects and the dictionary and the byte length of
+        strings and keys, ``max_size`` the size of the buffer, and
+        ``max_elements`` the number of values in the decoded document,
+        counting each back-reference as a full copy of the value it refers
+        to. Set ``max_elements`` for untrusted input: a small document with
+        nested back-references can otherwise decode to an enormous one.
+        Raises ValueError describing the first problem found.
+        """
+        # Other buffers (e.g. shared memory) are read in place, not copied
+        view = buffer if isinstance(buffer, bytes) else memoryview(buffer).cast('B')
+        end = len(view)
+        if max_size is not None and end > max_size:
+            raise ValueError(f"Buffer of {end} bytes exceeds limit of {max_size}")
+        
+        def varint(pos):
+            if pos < end and view[pos] < 128:
+                return view[pos], pos + 1
+            return CBD._decode_varint_checked(view, pos, end)
+        
+        def length(pos, what):
+            n, pos = varint(pos)
+            if max_length is not None and n > max_length:
+                raise ValueError(f"{what} length {n} exceeds limit of {max_length}")
+            return n, pos
+        
+        def skip_bytes(pos, n, utf8=False):
+            if n > end - pos:
+                raise ValueError("Truncated data")
+            if utf8 and check_utf8:
+                try:
+                    str(view[pos:pos + n], 'utf-8')
+                except UnicodeDecodeError as e:
+                    raise ValueError(f"Invalid UTF-8 at offset {pos}") from e
+            return pos + n
+        
+        # Header
+        if end < 4:
+            raise ValueError("Truncated header")
+        magic, version = struct.unpack_from(">HB", view, 0)
+        if magic != 0xCBD1:
+            raise ValueError("Invalid CBD format or version")
+        if version == 0x01:
+            flags, dict_size, pos = 0, view[3], 4
+        elif version == CBD.FORMAT_VERSION:
+            flags = view[3]
+            if flags & ~(CBD.FLAG_KEY_INDEX | CBD.FLAG_CHECKSUM):
+                raise ValueError(f"Unknown header flags: {flags:#04x}")
+            dict_size, pos = length(4, "Dictionary")
+        else:
+            raise ValueError("Invalid CBD format or version")
+        
+        # Dictionary
+        offsets = None
+        if flags & CBD.FLAG_KEY_INDEX:
+            slots = CBD._index_slots(dict_size)
+            keys_pos = skip_bytes(pos, 4 * (dict_size + 1 + slots))
+            offsets = struct.unpack_from(f">{dict_size + 1}I", view, pos)
+            table = struct.unpack_from(f">{slots}I", view, pos + 4 * (dict_size + 1))
+            if max(table) > dict_size:
+                raise ValueError("Key index refers to a key outside the dictionary")
+            pos = keys_pos
+        for i in range(dict_size):
+            if offsets is not None and pos - keys_pos != offsets[i]:
+                raise ValueError("Key index does not match dictionary")
+            n, pos = length(pos, "Key")
+            pos = skip_bytes(pos, n, utf8=True)
+        if offsets is not None and pos - keys_pos != offsets[dict_size]:
+            raise ValueError("Key index does not match dictionary")
+        
+        if flags & CBD.FLAG_CHECKSUM:
+            pos, end = CBD._verify_checksums(view, pos)
+        
+        # Data
+        inline_string = -1 if check_utf8 else min(127, max_length if max_length is not None else 127)
+        defined = 0
+        open_shared = set()  # shared values still being read
+        shared_sizes = []  # decoded element count of each shared value
+        elements = 1  # values in the decoded document, starting with the root
+        
+        def add_elements(n):
+            nonlocal elements
+            elements += n
+            if max_elements is not None and elements > max_elements:
+                raise ValueError(f"Decoded document exceeds limit of {max_elements} elements")
+        
+        def value(pos, depth):
+            nonlocal defined
+            if pos >= end:
+                raise ValueError("Truncated data")
+            type_byte = view[pos]
+            pos += 1
+            if type_byte == CBD.TYPE_STRING:
+                n, pos = length(pos, "String")
+                return skip_bytes(pos, n, utf8=True)
+            elif type_byte == CBD.TYPE_NUMBER:
+                return varint(pos)[1]
+            elif type_byte == CBD.TYPE_OBJECT or type_byte == CBD.TYPE_ARRAY:
+                is_object = type_byte == CBD.TYPE_OBJECT
+                n, pos = length(pos, "Object" if is_object else "Array")
+                if max_depth is not None and depth >= max_depth:
+                    raise ValueError(f"Nesting exceeds depth limit of {max_depth}")
+                add_elements(n)
+                for _ in range(n):
+                    if is_object:
+                        key_id, pos = varint(pos)
+                        if not 1 <= key_id <= dict_size:
+                            raise ValueError(f"Key index {key_id} out of range at offset {pos}")
+                    # Small numbers and short strings, the common case, are checked inline
+                    if pos + 1 < end:
+                        item_type, item_byte = view[pos], view[pos + 1]
+                        if item_type == CBD.TYPE_NUMBER and item_byte < 128:
+                            pos += 2
+                            continue
+                        if item_type == CBD.TYPE_STRING and item_byte <= inline_string and pos + 2 + item_byte <= end:
+                            pos += 2 + item_byte
+                            continue
+                    pos = value(pos, depth + 1)
+                return pos
+            elif type_byte == CBD.TYPE_NULL or type_byte == CBD.TYPE_BOOL or type_byte == CBD.TYPE_BOOL | 1:
+                return pos
+            elif type_byte == CBD.TYPE_SHARED:
+                ref_idx = defined
+                defined += 1
+                open_shared.add(ref_idx)
+                shared_sizes.append(0)
+                before = elements
+                pos = value(pos, depth)
+                open_shared.discard(ref_idx)
+                shared_sizes[ref_idx] = 1 + elements - before
+                return pos
+            elif type_byte == CBD.TYPE_REF:
+                ref_idx, pos = varint(pos)
+                if ref_idx >= defined or ref_idx in open_shared:
+                    raise ValueError(f"Invalid back-reference {ref_idx} at offset {pos}")
+                # Decoding copies the shared value; the reference itself is already counted
+                add_elements(shared_sizes[ref_idx] - 1)
+                return pos
+            elif type_byte >> 5 == CBD.TYPE_PACKED >> 5 and type_byte & 1 and (type_byte >> 1) & 15 <= CBD.PACK_DELTA:
+                return packed_array((type_byte >> 1) & 15, pos)
+            raise ValueError(f"Invalid type byte {type_byte:#04x} at offset {pos - 1}")
+        
+        def packed_array(codec, pos):
+            n, pos = length(pos, "Array")
+            add_elements(n)
+            if codec == CBD.PACK_BOOLS:
+                pos = skip_bytes(pos, (n + 7) // 8)
+            elif codec == CBD.PACK_OPTIONAL_BOOLS:
+                pos = skip_bytes(pos, 2 * ((n + 7) // 8))
+            elif codec == CBD.PACK_RLE:
+                runs, pos = varint(pos)
+                total = 0
+                for _ in range(runs):
+                    count, pos = varint(pos)
+                    total += count
+                    if pos < end and view[pos] >> 5 > CBD.TYPE_STRING >> 5:
+                        raise ValueError(f"Run value at offset {pos} is not a scalar")
+                    pos = value(pos, 0)
+                if total != n:
+                    raise ValueError(f"Run lengths add up to {total}, expected {n}")
+            elif codec == CBD.PACK_DELTA:
+                val = 0
+                for _ in range(n):
+                    zigzag, pos = varint(pos)
+                    val += (zigzag >> 1) ^ -(zigzag & 1)
+                    if val < 0:
+                        raise ValueError(f"Negative integer in delta array at offset {pos}")
+            return pos
+        
+        try:
+            pos = value(pos, 0)
+        except RecursionError:
+            raise ValueError("Nesting too deep to decode") from None
+        
+        if pos != end:
+            raise ValueError(f"{end - pos} unexpected bytes after data")
+    
+    @staticmethod
+    def diff(base, new):
+        """Encode the changes that turn ``base`` into ``new`` as a CBD patch.
+        
+        The patch is a list of set, delete and array-splice operations
+        addressed by path. Object keys in paths and values are numbered
+        against the dictionary of ``base``; only keys the base does not
+        contain are written to the patch.
+        """
+        ops = []
+        CBD._diff_value(base, new, [], ops)
+        
+        # Extend the base dictionary with any keys it does not have
+        key_ids = {k: i + 1 for i, k in enumerate(CBD._collect_keys(base))}
+        base_size = len(key_ids)
+        def key_id(k):
+            if k not in key_ids:
+                key_ids[k] = len(key_ids) + 1
+            return key_ids[k]
+        for op in ops:
+            op[1] = [key_id(seg) if isinstance(seg, str) else seg for seg in op[1]]
+            if op[0] != CBD.OP_DELETE:
+                for k in CBD._collect_keys(op[-1]):
+                    key_id(k)
+        new_keys = list(key_ids)[base_size:]
+        
+        # Header: Magic (0xCBDF), Version (0x01), Base Dictionary Size, New Keys
+        buffer = BytesIO()
+        buffer.write(struct.pack(">HB", CBD.PATCH_MAGIC, 0x01))
+        buffer.write(CBD._encode_varint(base_size))
+        buffer.write(CBD._encode_varint(len(new_keys)))
+        CBD._write_keys(buffer, new_keys)
+        CBD._write_value(buffer, ops, key_ids)
+        return buffer.getvalue()
+    
+    @staticmethod
+    def _diff_value(a, b, path, ops):
+        """Append the operations that turn ``a`` into ``b`` at ``path`` to ``ops``."""
+        if a is b:
+            return
+        if isinstance(a, dict) and isinstance(b, dict):
+            for k in a:
+                if k not in b:
+                    ops.append([CBD.OP_DELETE, path + [k]])
+            for k, v in b.items():
+                if k in a:
+                    CBD._diff_value(a[k], v, path + [k], ops)
+                else:
+                    ops.append([CBD.OP_SET, path + [k], v])
+        elif isinstance(a, list) and isinstance(b, list):
+            if len(a) == len(b):
+                for i, (x, y) in enumerate(zip(a, b)):
+                    CBD._diff_value(x, y, path + [i], ops)
+                return
+            # Replace everything between the common prefix and suffix
+            shortest = min(len(a), len(b))
+            start = 0
+            while start < shortest and type(a[start]) is type(b[start]) and a[start] == b[start]:
+                start += 1
+            end = 0
+            while (end < shortest - start and type(a[-1 - end]) is type(b[-1 - end])
+                   and a[-1 - end] == b[-1 - end]):
+                end += 1
+            ops.append([CBD.OP_SPLICE, path, start, len(a) - start - end, b[start:len(b) - end]])
+        elif type(a) is not type(b) or a != b:
+            ops.append([CBD.OP_SET, path, b])
+    
+    @staticmethod
+    def apply(base, patch, in_place=False):
+        """Apply a patch produced by ``diff`` to ``base`` and return the new version.
+        
+        ``base`` is left untouched unless ``in_place`` is set; the return
+        value must be used either way, since a patch may replace the root.
+        Containers on the path of each change are copied before they are
+        modified, so sub-objects that ``base`` shares between several paths
+        only change where the patch says. Without ``in_place`` the result
+        shares unchanged sub-objects with ``base``.
+        """
+        magic, version = struct.unpack_from(">HB", patch, 0)
+        if magic != CBD.PATCH_MAGIC or version != 0x01:
+            raise ValueError("Invalid CBD patch format or version")
+        pos = 3
+        
+        keys = CBD._collect_keys(base)
+        base_size, pos = CBD._decode_varint(patch, pos)
+        if base_size != len(keys):
+            raise ValueError("Patch was not made against this base")
+        new_count, pos = CBD._decode_varint(patch, pos)
+        new_keys, pos = CBD._read_keys(patch, pos, new_count)
+        keys.extend(new_keys)
+        ops, pos = CBD._read_value(patch, pos, keys)
+        
+        if not in_place and isinstance(base, (dict, list)):
+            base = copy.copy(base)
+        copied = {id(base): base}  # containers this call created, safe to modify
+        
+        def segment(container, seg):
+            return keys[seg - 1] if isinstance(container, dict) else seg
+        
+        def child(container, seg):
+            # Copy on the way down, so an aliased sub-object is not changed elsewhere
+            key = segment(container, seg)
+            value = container[key]
+            if isinstance(value, (dict, list)) and id(value) not in copied:
+                value = container[key] = copy.copy(value)
+                copied[id(value)] = value
+            return value
+        
+        for op in ops:
+            code, path = op[0], op[1]
+            if code == CBD.OP_SPLICE:
+                target = base
+                for seg in path:
+                    target = child(target, seg)
+                start, count, items = op[2], op[3], op[4]
+                target[start:start + count] = items
+                continue
+            if not path:
+                if code != CBD.OP_SET:
+                    raise ValueError("Cannot delete the root value")
+                base = op[2]
+                copied[id(base)] = base
+                continue
+            parent = base
+            for seg in path[:-1]:
+                parent = child(parent, seg)
+            if code == CBD.OP_SET:
+                parent[segment(parent, path[-1])] = op[2]
+            elif code == CBD.OP_DELETE:
+                del parent[segment(parent, path[-1])]
+            else:
+                raise ValueError(f"Unknown patch operation: {code}")
+        return base
+
+class DeltaProducer:
+    """Encode successive versions of a document as patches against the previous one.
+    
+    Each message is a varint version number followed by either a full CBD
+    document or a patch. A full document is sent for the first version,
+    after ``reset()``, and every ``keyframe_interval`` versions if set.
+    """
+    
+    def __init__(self, keyframe_interval=None):
+        self.keyframe_interval = keyframe_interval
+        self.version = 0
+        self._base = None
+    
+    def reset(self):
+        """Send a full document next, e.g. after a consumer lost a message."""
+        self._base = None
+    
+    def encode(self, data):
+        """Return the message that brings a consumer up to date with ``data``."""
+        self.version += 1
+        keyframe = self.keyframe_interval and self.version % self.keyframe_interval == 0
+        if self._base is None or keyframe:
+            payload = CBD.serialize(data)
+            # Snapshot, so later in-place edits by the caller show up in the next diff
+            self._base = copy.deepcopy(data)
+        else:
+            payload = CBD.diff(self._base, data)
+            # Rebuild the consumer's state rather than copying ``data``: key IDs
+            # depend on key order, which patches do not carry
+            self._base = CBD.apply(self._base, payload)
+        return CBD._encode_varint(self.version) + payload
+
+class DeltaConsumer:
+    """Rebuild the documents sent by a ``DeltaProducer``.
+    
+    Patches are applied in place to ``state``, so the returned document
+    should be treated as read-only.
+    """
+    
+    def __init__(self):
+        self.version = 0
+        self.state = None
+    
+    def decode(self, message):
+        """Apply one producer message and return the current document."""
+        version, pos = CBD._decode_varint(message, 0)
+        payload = message[pos:]
+        if struct.unpack_from(">H", payload)[0] == CBD.PATCH_MAGIC:
+            if self.state is None or version != self.version + 1:
+                raise ValueError(f"Patch for version {version} cannot be applied to version {self.version}")
+            self.state = CBD.apply(self.state, payload, in_place=True)
+        else:
+            self.state = CBD.deserialize(payload)
+        self.version = version
+        return self.state
+
+class CBDEncoder:
+    """Reusable encoder for a stream of messages, to be used by one thread at a time.
+    
+    Produces the same bytes as ``CBD.serialize(data, key_index=...,
+    checksum=...)`` but writes into an output buffer kept between calls,
+    and remembers the encoded header and key IDs of the most recent
+    dictionaries, so messages with a familiar set of keys skip rebuilding
+    them.
+    """
+    
+    def __init__(self, key_index=False, checksum=False, max_shapes=64):
+        self.key_index = key_index
+        self.checksum = checksum
+        self.max_shapes = max_shapes
+        self._buffer = bytearray()
+        self._counts = {}
+        self._shapes = OrderedDict()  # tuple of keys -> (header, key ID varints)
+    
+    def encode(self, data):
+        """Encode ``data``, returning bytes."""
+        return bytes(self._encode(data))
+    
+    def encode_into(self, data, buffer, offset=0):
+        """Encode ``data`` into the writable ``buffer`` at ``offset``, returning the size written."""
+        encoded = self._encode(data)
+        size = len(encoded)
+        with memoryview(buffer) as view:
+            if offset + size > len(view):
+                raise ValueError(f"Buffer too small: {size} bytes needed at offset {offset}")
+            view[offset:offset + size] = encoded
+        return size
+    
+    def encode_view(self, data):
+        """Encode ``data``, returning a memoryview of the internal buffer.
+        
+        The view is only valid until the next call on this encoder.
+        """
+        return memoryview(self._encode(data))
+    
+    def _encode(self, data):
+        """Encode ``data`` into the internal buffer and return it."""
+        buffer = self._buffer
+        try:
+            del buffer[:]
+        except BufferError:
+            # A view from encode_view() is still held; leave that buffer to it
+            buffer = self._buffer = bytearray()
+        
+        counts = self._counts
+        counts.clear()
+        if isinstance(data, (dict, list)):
+            self._count_keys(data, counts)
+        keys = tuple(CBD._order_keys(counts))
+        shape = self._shapes.get(keys)
+        if shape is None:
+            header = BytesIO()
+            CBD._write_header(header, keys, self.key_index, self.checksum)
+            shape = self._shapes[keys] = (header.getvalue(), {k: CBD._encode_varint(i + 1) for i, k in enumerate(keys)})
+            if len(self._shapes) > self.max_shapes:
+                self._shapes.popitem(last=False)
+        else:
+            self._shapes.move_to_end(keys)
+        header, key_ids = shape
+        
+        buffer += header
+        self._write_value(buffer, data, key_ids)
+        if self.checksum:
+            self._add_checksums(buffer, len(header))
+        return buffer
+    
+    def _count_keys(self, obj, counts):
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                counts[k] = counts.get(k, 0) + 1
+                if isinstance(v, (dict, list)):
+                    self._count_keys(v, counts)
+        else:
+            for v in obj:
+                if isinstance(v, (dict, list)):
+                    self._count_keys(v, counts)
+    
+    def _write_value(self, buffer, val, key_ids):
+        # Same encoding as CBD._write_value, appending to a bytearray
+        # without creating a bytes object for every type byte and length
+        if isinstance(val, list):
+            packed = CBD._encode_scalar_array(val) if len(val) >= CBD.MIN_PACKED_LENGTH else None
+            if packed is not None:
+                buffer += packed
+                return
+            buffer.append(CBD.TYPE_ARRAY)
+            self._write_varint(buffer, len(val))
+            for item in val:
+                self._write_value(buffer, item, key_ids)
+        elif isinstance(val, dict):
+            buffer.append(CBD.TYPE_OBJECT)
+            self._write_varint(buffer, len(val))
+            for k, v in val.items():
+                buffer += key_ids[k]
+                self._write_value(buffer, v, key_ids)
+        elif isinstance(val, str):
+            val_bytes = val.encode('utf-8')
+            buffer.append(CBD.TYPE_STRING)
+            self._write_varint(buffer, len(val_bytes))
+            buffer += val_bytes
+        elif val is None or isinstance(val, bool):
+            buffer.append(CBD.TYPE_NULL if val is None else CBD.TYPE_BOOL | val)
+        elif isinstance(val, (int, float)):
+            buffer.append(CBD.TYPE_NUMBER)
+            self._write_varint(buffer, int(val))
+        else:
+            raise ValueError(f"Unsupported type: {type(val)}")
+    
+    @staticmethod
+    def _write_varint(buffer, n):
+        if 0 <= n < 128:
+            buffer.append(n)
+        else:
+            buffer += CBD._encode_varint(n)
+    
+    @staticmethod
+    def _add_checksums(buffer, data_start):
+        """Add the checksum section of ``CBD._add_checksums`` to ``buffer`` in place."""
+        block = CBD.CHECKSUM_BLOCK_SIZE
+        with memoryview(buffer) as view:
+            header_crc = zlib.crc32(view[:data_start])
+            data_len = len(view) - data_start
+            crcs = [zlib.crc32(view[i:min(i + block, len(view))]) for i in range(data_start, len(view), block)]
+        buffer[data_start:data_start] = struct.pack(">I", header_crc) + CBD._encode_varint(data_len) + CBD._encode_varint(block)
+        buffer += struct.pack(f">{len(crcs)}I", *crcs)
+
+class CBDDecoder:
+    """Reusable decoder for a stream of messages, to be used by one thread at a time.
+    
+    Remembers recent dictionaries, so messages that repeat a set
+    of keys share the decoded key strings instead of decoding them again,
+    and decodes straight from any bytes-like object without copying it.
+    """
+    
+    def __init__(self, shared=False, max_shapes=64):
+        self.shared = shared
+        self.max_shapes = max_shapes
+        self._dictionaries = OrderedDict()  # encoded dictionary -> keys
+    
+    def decode(self, binary):
+        """Decode one document, like ``CBD.deserialize``."""
+        return self.decode_from(binary)[0]
+    
+    def decode_from(self, buffer, offset=0):
+        """Decode the document at ``offset`` in ``buffer``, returning it with the offset after it.
+        
+        Further data may follow the document, so consecutive documents can
+        be read from one buffer.
+        """
+        if offset == 0 and isinstance(buffer, (bytes, bytearray)):
+            view = buffer
+        else:
+            view = memoryview(buffer).cast('B')[offset:]
+        dictionaries = self._dictionaries
+        keys, flags, pos = CBD._read_header(view, dictionaries, verify=False)
+        while len(dictionaries) > self.max_shapes:
+            dictionaries.popitem(last=False)
+        
+        if flags & CBD.FLAG_CHECKSUM:
+            # Bound the document by its checksum section before verifying it
+            data_len, end = CBD._decode_varint_checked(view, pos + 4, len(view))
+            block, end = CBD._decode_varint_checked(view, end, len(view))
+            blocks = -(-data_len // block) if block else 0
+            end += data_len + 4 * blocks
+            pos, _ = CBD._verify_checksums(memoryview(view)[:end], pos)
+            return CBD._read_value(view, pos, keys, self.shared)[0], offset + end
+        
+        value, end = CBD._read_value(view, pos, keys, self.shared)
+        return value, offset + end
+
+class _Loan:
+    """Object borrowed from a ``CBDPool``, returned when the ``with`` block exits."""
+    
+    def __init__(self, pool, item):
+        self.pool = pool
+        self.item = item
+    
+    def __enter__(self):
+        return self.item
+    
+    def __exit__(self, *exc_info):
+        self.pool.release(self.item)
+
+class CBDPool:
+    """Thread-safe pool of ``CBDEncoder`` or ``CBDDecoder`` objects for thread-pool servers.
+    
+    Each request borrows an encoder or decoder, keeping its warm buffers
+    and caches, and returns it afterwards::
+    
+        encoders = CBDPool(CBDEncoder, key_index=True)
+        with encoders.borrow() as encoder:
+            payload = encoder.encode(message)
+    """
+    
+    def __init__(self, factory, max_idle=8, **options):
+        self.factory = factory
+        self.max_idle = max_idle
+        self.options = options
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.factory(**self.options)
+    
+    def release(self, item):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(item)
+    
+    def borrow(self):
+        return _Loan(self, self.acquire())
+
+class _ViewDocument:
+    """Buffer and dictionary shared by the ``CBDView`` objects of one document."""
+    
+    def __init__(self, buffer, keys):
+        self.buffer = buffer
+        self.keys = keys
+        self._shared = None
+        self._data_pos = None
+    
+    def __getitem__(self, ref_idx):
+        # Offsets of shared values, found by scanning the whole document the
+        # first time a back-reference is followed
+        if self._shared is None:
+            self._shared = []
+            CBD._skip_value(self.buffer, self._data_pos, self._shared)
+        return self._shared[ref_idx]
+    
+    def value_at(self, pos):
+        """Return a view for an array or object at ``pos``, or the decoded value otherwise."""
+        if self._data_pos is None:
+            self._data_pos = pos
+        while True:
+            type_byte = self.buffer[pos]
+            if type_byte == CBD.TYPE_SHARED:
+                pos += 1
+            elif type_byte == CBD.TYPE_REF:
+                pos = self[CBD._decode_varint(self.buffer, pos + 1)[0]][0]
+            else:
+                break
+        if type_byte in (CBD.TYPE_ARRAY, CBD.TYPE_OBJECT):
+            return CBDView(self, pos)
+        return CBD._read_value(self.buffer, pos, self.keys, refs=self)[0]
+
+class CBDView:
+    """Read-only view of an encoded array or object, decoded on access.
+    
+    Behaves like a list or dict. Elements are located on first access by
+    skipping over the encoding; nested arrays and objects are returned as
+    views, and ``decode()`` builds the full Python object.
+    """
+    
+    def __init__(self, document, pos):
+        self._document = document
+        self._pos = pos
+        self._index = None  # dict of key -> offset, or list of offsets
+    
+    @property
+    def is_object(self):
+        return self._document.buffer[self._pos] == CBD.TYPE_OBJECT
+    
+    def _offsets(self):
+        if self._index is None:
+            buffer = self._document.buffer
+            length, pos = CBD._decode_varint(buffer, self._pos + 1)
+            if self.is_object:
+                keys = self._document.keys
+                index = {}
+                for _ in range(length):
+                    key_idx, pos = CBD._decode_varint(buffer, pos)
+                    index[keys[key_idx-1]] = pos
+                    pos = CBD._skip_value(buffer, pos)
+            else:
+                index = []
+                for _ in range(length):
+                    index.append(pos)
+                    pos = CBD._skip_value(buffer, pos)
+            self._index = index
+        return self._index
+    
+    def __len__(self):
+        return CBD._decode_varint(self._document.buffer, self._pos + 1)[0]
+    
+    def __getitem__(self, key):
+        return self._document.value_at(self._offsets()[key])
+    
+    def __contains__(self, item):
+        if self.is_object:
+            return item in self._offsets()
+        return any(value == item for value in self)
+    
+    def __iter__(self):
+        if self.is_object:
+            return iter(self._offsets())
+        return (self._document.value_at(pos) for pos in self._offsets())
+    
+    def get(self, key, default=None):
+        pos = self._offsets().get(key)
+        return default if pos is None else self._document.value_at(pos)
+    
+    def keys(self):
+        return self._offsets().keys()
+    
+    def values(self):
+        return [self._document.value_at(pos) for pos in (self._offsets().values() if self.is_object else self._offsets())]
+    
+    def items(self):
+        return [(key, self._document.value_at(pos)) for key, pos in self._offsets().items()]
+    
+    def decode(self):
+        """Decode the whole array or object."""
+        return CBD._read_value(self._document.buffer, self._pos, self._document.keys, refs=self._document)[0]
+
+SharedDescriptor = namedtuple('SharedDescriptor', ['name', 'size'])
+SharedDescriptor.__doc__ = """Picklable handle to a CBD document in a shared memory segment."""
+
+class SharedLease:
+    """A document written into a pooled segment; release it once every reader is done."""
+    
+    def __init__(self, pool, descriptor):
+        self.pool = pool
+        self.descriptor = descriptor
+        self.released = False
+    
+    def release(self):
+        """Return the segment to the pool; further calls do nothing."""
+        if not self.released:
+            self.released = True
+            self.pool.release(self.descriptor)
+    
+    def __enter__(self):
+        return self.descriptor
+    
+    def __exit__(self, *exc_info):
+        self.release()
+
+class SharedMemoryPool:
+    """Pool of shared memory segments for passing CBD documents between processes.
+    
+    The producer encodes a document once with ``put`` and sends the small
+    ``SharedDescriptor`` to any number of consumers, which decode it in
+    place with ``SharedMemoryPool.load`` or open a lazy view with
+    ``SharedMemoryPool.view``; a consumer only maps the segment while it
+    reads it. Once all consumers are done the producer
+    releases the lease and the segment is reused for a later document.
+    Segments are unlinked when the pool is closed.
+    
+    Before Python 3.13, consumers in processes not started by the producer
+    (and so not sharing its resource tracker) unlink attached segments when
+    they exit; start consumers with ``multiprocessing`` in that case.
+    """
+    
+    def __init__(self, min_size=64 * 1024, max_idle=8):
+        self.min_size = min_size
+        self.max_idle = max_idle
+        self._idle = []
+        self._leased = {}
+        self._lock = threading.Lock()
+    
+    def put(self, data, encoder=None, **options):
+        """Serialize ``data`` into a pooled segment.
+        
+        ``options`` are passed to ``CBD.serialize``, or a ``CBDEncoder`` can
+        be given to encode with instead.
+        """
+        if encoder is not None:
+            encoded = encoder.encode_view(data)
+        else:
+            encoded = CBD.serialize(data, **options)
+        segment = self._acquire(len(encoded))
+        segment.buf[:len(encoded)] = encoded
+        descriptor = SharedDescriptor(segment.name, len(encoded))
+        with self._lock:
+            self._leased[segment.name] = segment
+        return SharedLease(self, descriptor)
+    
+    def _acquire(self, size):
+        """Take the smallest idle segment that fits ``size`` bytes, or create one."""
+        from multiprocessing import shared_memory
+        with self._lock:
+            fitting = [seg for seg in self._idle if seg.size >= size]
+            if fitting:
+                segment = min(fitting, key=lambda seg: seg.size)
+                self._idle.remove(segment)
+                return segment
+        return shared_memory.SharedMemory(create=True, size=max(self.min_size, 1 << (size - 1).bit_length()))
+    
+    def release(self, descriptor):
+        """Return the segment holding ``descriptor`` to the pool."""
+        with self._lock:
+            segment = self._leased.pop(descriptor.name, None)
+            if segment is None:
+                raise ValueError(f"Segment {descriptor.name} is not leased from this pool")
+            if len(self._idle) < self.max_idle:
+                self._idle.append(segment)
+                return
+        segment.close()
+        segment.unlink()
+    
+    def close(self):
+        """Unlink every segment owned by the pool, including leased ones."""
+        with self._lock:
+            segments = self._idle + list(self._leased.values())
+            self._idle = []
+            self._leased = {}
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    @staticmethod
+    def _attach(descriptor):
+        """Map the segment holding ``descriptor`` into this process."""
+        from multiprocessing import shared_memory
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=descriptor.name, track=False)
+        return shared_memory.SharedMemory(name=descriptor.name)
+    
+    @staticmethod
+    def load(descriptor, shared=False):
+        """Decode a document straight from its shared memory segment."""
+        segment = SharedMemoryPool._attach(descriptor)
+        try:
+            with segment.buf[:descriptor.size] as buffer:
+                return CBD.deserialize(buffer, shared)
+        finally:
+            segment.close()
+    
+    @staticmethod
+    def view(descriptor):
+        """Open a lazy view of a document in shared memory.
+        
+        Returns a ``SharedView``, which keeps the segment mapped until it is
+        closed. It reads the segment directly, so it is only valid until the
+        producer releases the document.
+        """
+        return SharedView(descriptor)
+
+class SharedView:
+    """Lazy view of a document in shared memory, holding the segment mapping.
+    
+    Use it as a context manager, which gives the ``CBDView`` (or scalar)
+    of the document, or read ``root`` and call ``close()`` when done.
+    Views taken from it must not be used after it is closed.
+    """
+    
+    def __init__(self, descriptor):
+        self._segment = SharedMemoryPool._attach(descriptor)
+        self._buffer = self._segment.buf[:descriptor.size]
+        try:
+            self.root = CBD.view(self._buffer)
+        except Exception:
+            self.close()
+            raise
+    
+    def close(self):
+        """Unmap the segment; further access through views raises ValueError."""
+        if self._segment is not None:
+            self.root = None
+            self._buffer.release()
+            self._segment.close()
+            self._segment = None
+    
+    def __enter__(self):
+        return self.root
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class KeyIndex:
+    """Dictionary of a buffer written with ``key_index=True``, decoded on demand.
+    
+    Behaves like the list of keys (indexed from 0), but only decodes the
+    entries that are actually used, and looks keys up by name through the
+    hash index instead of a scan.
+    """
+    
+    def __init__(self, buffer, pos, count):
+        self._buffer = buffer
+        self._count = count
+        self._offsets_pos = pos
+        self._slots = CBD._index_slots(count)
+        self._table_pos = pos + 4 * (count + 1)
+        self._keys_pos = self._table_pos + 4 * self._slots
+        self._keys = [None] * count
+        self.end = self._keys_pos + struct.unpack_from(">I", buffer, pos + 4 * count)[0]
+    
+    def __len__(self):
+        return self._count
+    
+    def __getitem__(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError("Key index out of range")
+        key = self._keys[i]
+        if key is None:
+            offset = struct.unpack_from(">I", self._buffer, self._offsets_pos + 4 * i)[0]
+            length, pos = CBD._decode_varint(self._buffer, self._keys_pos + offset)
+            key = str(self._buffer[pos:pos+length], 'utf-8')
+            self._keys[i] = key
+        return key
+    
+    def __iter__(self):
+        return (self[i] for i in range(self._count))
+    
+    def id_of(self, key):
+        """Return the 1-based ID of ``key``, or 0 if the dictionary does not contain it."""
+        key_bytes = key.encode('utf-8')
+        mask = self._slots - 1
+        slot = zlib.crc32(key_bytes) & mask
+        while True:
+            key_id = struct.unpack_from(">I", self._buffer, self._table_pos + 4 * slot)[0]
+            if key_id == 0 or self[key_id - 1] == key:
+                return key_id
+            slot = (slot + 1) & mask
+
+class EncodeCache:
+    """Bounded LRU cache of encoded arrays and objects shared across calls.
+    
+    Pass the same instance to ``CBD.serialize(..., cache=...)`` so hot
+    sub-objects that reappear in later documents are copied from the cache
+    instead of being encoded again. Entries are keyed by object identity:
+    only pass objects that are not mutated after they are first serialized.
+    Each entry holds a reference to its object so the id cannot be reused.
+    """
+    
+    def __init__(self, max_bytes=1 << 20, max_entries=4096, min_size=32):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.min_size = min_size  # smaller fragments are cheaper to re-encode
+        self.size = 0
+        self._entries = OrderedDict()  # id(obj) -> (obj, key_counts, key_ids, fragment)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def get(self, obj):
+        """Return the entry for ``obj``, marking it most recently used."""
+        entry = self._entries.get(id(obj))
+        if entry is None or entry[0] is not obj:
+            return None
+        self._entries.move_to_end(id(obj))
+        return entry
+    
+    def put(self, obj, key_counts, key_ids, fragment):
+        """Store the fragment of ``obj``, encoded with ``key_ids`` for the keys of ``key_counts``."""
+        if len(fragment) < self.min_size or len(fragment) > self.max_bytes:
+            return
+        old = self._entries.pop(id(obj), None)
+        if old is not None:
+            self.size -= len(old[3])
+        self._entries[id(obj)] = (obj, key_counts, key_ids, fragment)
+        self.size += len(fragment)
+        while self.size > self.max_bytes or len(self._entries) > self.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted[3])
+    
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
 
 # Test and measure sizes
 if __name__ == "__main__":
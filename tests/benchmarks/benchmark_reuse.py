@@ -0,0 +1,60 @@
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+from cbd import CBD, CBDDecoder, CBDEncoder
+
+# A stream of similarly shaped messages, as a service would send them:
+# the static API against reusable encoder and decoder objects.
+MESSAGES = [
+    {
+        "id": i,
+        "user": {"name": f"user{i}", "email": f"user{i}@example.com", "active": i % 2 == 0},
+        "items": [{"sku": j, "qty": j % 3, "price": j * 7} for j in range(5)],
+        "ts": 1700000000 + i,
+    }
+    for i in range(5000)
+]
+
+def measure(func, items):
+    """Return (microseconds per call, peak bytes allocated by one call) for ``func`` over ``items``."""
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    elapsed = (time.perf_counter() - start) / len(items)
+    
+    # Peak memory each call allocates on top of what is already live
+    tracemalloc.start()
+    peaks = []
+    for item in items[:200]:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func(item)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return elapsed * 1e6, sorted(peaks)[len(peaks) // 2]
+
+def run(**options):
+    encoder = CBDEncoder(**options)
+    decoder = CBDDecoder()
+    buffer = bytearray(1 << 16)
+    encoded = [CBD.serialize(m, **options) for m in MESSAGES]
+    views = [memoryview(b) for b in encoded]
+    
+    rows = [
+        ("CBD.serialize", measure(lambda m: CBD.serialize(m, **options), MESSAGES)),
+        ("CBDEncoder.encode", measure(encoder.encode, MESSAGES)),
+        ("CBDEncoder.encode_into", measure(lambda m: encoder.encode_into(m, buffer), MESSAGES)),
+        ("CBD.deserialize", measure(CBD.deserialize, views)),
+        ("CBDDecoder.decode_from", measure(decoder.decode_from, views)),
+    ]
+    print(f"Options: {options or 'none'}")
+    for name, (micros, peak) in rows:
+        print(f"  {name:<24} {micros:8.2f} us/message {peak:8d} bytes peak")
+
+if __name__ == '__main__':
+    run()
+    run(key_index=True)
+    run(checksum=True)
@@ -0,0 +1,44 @@
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Cold-start cost of a single conversion: a fresh interpreter imports the
+# converter and turns a small JSON document into CBD, as the CLI does.
+UTILS_DIR = Path(__file__).parent.parent / 'utils'
+SNIPPET = (
+    "import sys; sys.path.insert(0, {utils!r});"
+    "from format_converter import FormatConverter;"
+    "FormatConverter.json_to_cbd('{{\"name\": \"John\", \"age\": 30}}');"
+    "print(','.join(m for m in ('msgpack', 'bson', 'orjson', 'ujson') if m in sys.modules))"
+)
+
+def measure_cold_start(runs=20):
+    """Return (median seconds, backend modules imported) over ``runs`` fresh interpreters."""
+    code = SNIPPET.format(utils=str(UTILS_DIR))
+    timings = []
+    loaded = ''
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        timings.append(time.perf_counter() - start)
+        loaded = result.stdout.strip()
+    return statistics.median(timings), loaded
+
+def measure_interpreter(runs=20):
+    """Median start-up time of a bare interpreter, to subtract from the above."""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+if __name__ == '__main__':
+    baseline = measure_interpreter()
+    cold, loaded = measure_cold_start()
+    print(f"Interpreter start-up:       {baseline * 1000:8.2f} ms")
+    print(f"JSON -> CBD cold start:     {cold * 1000:8.2f} ms")
+    print(f"Converter overhead:         {(cold - baseline) * 1000:8.2f} ms")
+    print(f"Backend modules imported:   {loaded or 'none'}")
@@ -0,0 +1,371 @@
+import array
+import copy
+import mmap
+import multiprocessing
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import sys
+
+# Add parent directory to path to import CBD
+sys.path.append(str(Path(__file__).parent.parent))
+from cbd import CBD, CBDDecoder, CBDEncoder, CBDPool, CBDView, DeltaConsumer, DeltaProducer, EncodeCache, KeyIndex, SharedMemoryPool
+
+ADDRESS = {
+    "street": "123 Main St",
+    "city": "Anytown",
+    "tags": ["home", "billing"]
+}
+
+DOCUMENT = {
+    "people": [
+        {"name": "John", "address": dict(ADDRESS), "billing": ADDRESS},
+        {"name": "Jane", "address": dict(ADDRESS), "billing": ADDRESS}
+    ],
+    "empty": [[], {}],
+    "active": True
+}
+
+def test_round_trip():
+    assert CBD.deserialize(CBD.serialize(DOCUMENT)) == DOCUMENT
+
+def test_many_keys():
+    data = {f"key{i}": i for i in range(70000)}
+    assert CBD.deserialize(CBD.serialize(data)) == data
+
+def test_frequent_keys_get_short_ids():
+    data = {f"rare{i}": None for i in range(200)}
+    data["items"] = [{"hot": i} for i in range(50)]
+    binary = CBD.serialize(data)
+    assert CBD.deserialize(binary) == data
+    keys, _, _ = CBD._read_header(binary)
+    assert keys[0] == "hot"
+
+def test_key_index():
+    data = {f"key{i}": i % 100 for i in range(1000)}
+    binary = CBD.serialize(data, key_index=True)
+    assert CBD.deserialize(binary) == data
+    
+    keys, flags, _ = CBD._read_header(binary)
+    assert isinstance(keys, KeyIndex)
+    assert flags & CBD.FLAG_KEY_INDEX
+    assert keys[keys.id_of("key123") - 1] == "key123"
+    assert keys.id_of("missing") == 0
+
+def test_version_1_buffer():
+    # Header with a one-byte dictionary size, as written by format version 1
+    assert CBD.deserialize(bytes.fromhex("cbd10101" "0161" "a101014005")) == {"a": 5}
+
+def test_dedup_round_trip():
+    binary = CBD.serialize(DOCUMENT, dedup=True)
+    assert CBD.deserialize(binary) == DOCUMENT
+    assert len(binary) < len(CBD.serialize(DOCUMENT))
+
+def test_dedup_copies_by_default():
+    result = CBD.deserialize(CBD.serialize(DOCUMENT, dedup=True))
+    first, second = result["people"]
+    assert first["address"] == second["billing"]
+    assert first["address"] is not second["billing"]
+
+    first["address"]["tags"].append("work")
+    assert second["address"]["tags"] == ["home", "billing"]
+
+def test_dedup_shared():
+    result = CBD.deserialize(CBD.serialize(DOCUMENT, dedup=True), shared=True)
+    first, second = result["people"]
+    assert first["address"] is second["address"] is first["billing"]
+
+@pytest.mark.parametrize("data", [None, 1, "text", [], {}, [[1, 2], [1, 2], [[1, 2]]]])
+def test_dedup_edge_cases(data):
+    assert CBD.deserialize(CBD.serialize(data, dedup=True)) == data
+
+def test_encode_cache():
+    cache = EncodeCache()
+    for i in range(3):
+        message = {"id": i, "people": DOCUMENT["people"]}
+        # Cached fragments must produce exactly the uncached encoding
+        assert CBD.serialize(message, cache=cache) == CBD.serialize(message)
+    assert len(cache) > 0
+
+def test_encode_cache_key_ids_change():
+    cache = EncodeCache(min_size=0)
+    CBD.serialize({"billing": ADDRESS}, cache=cache)
+    # Same sub-object, but its keys now get different IDs
+    message = {"extra": 1, "other": 2, "billing": ADDRESS}
+    assert CBD.deserialize(CBD.serialize(message, cache=cache)) == message
+
+def test_encode_cache_bounded():
+    cache = EncodeCache(max_bytes=256, min_size=0)
+    for i in range(100):
+        CBD.serialize({"item": {"value": "x" * 20, "index": i}}, cache=cache)
+    assert cache.size <= 256
+
+@pytest.mark.parametrize("array", [
+    [True, False, False, True, True, False, True, False, True],
+    [None] * 10,
+    [True, None, False, None, True],
+    list(range(1700000000, 1700000600, 60)),
+    [7] * 20 + [8] * 20,
+    ["on", "on", "on", "off", "off", "off"],
+    [3, 1, 4, 1, 5, 9, 2, 6],
+    [1, True, 1, 1, 1],
+])
+def test_packed_arrays(array):
+    result = CBD.deserialize(CBD.serialize({"values": array}))["values"]
+    assert result == array
+    assert [type(v) for v in result] == [type(v) for v in array]
+
+def test_packed_arrays_are_smaller():
+    flags = [i % 3 == 0 for i in range(100)]
+    timestamps = list(range(1700000000, 1700006000, 60))
+    assert len(CBD.serialize(flags)) < len(flags) // 4
+    assert len(CBD.serialize(timestamps)) < len(timestamps) * 2
+
+@pytest.mark.parametrize("options", [{}, {"dedup": True}, {"key_index": True}, {"checksum": True}])
+def test_validate(options):
+    data = dict(DOCUMENT, flags=[True, False] * 10, ids=list(range(100, 200)))
+    binary = CBD.serialize(data, **options)
+    CBD.validate(binary, check_utf8=True)
+    assert CBD.deserialize(binary) == data
+
+@pytest.mark.parametrize("binary", [
+    b"",
+    bytes.fromhex("cbd1020001"),  # dictionary entry missing
+    bytes.fromhex("cbd10200" "01" "0161" "a101" "02" "4005"),  # key index out of range
+    bytes.fromhex("cbd10200" "00" "8103" "40"),  # truncated array
+    bytes.fromhex("cbd10200" "00" "4005" "00"),  # trailing bytes
+    bytes.fromhex("cbd10200" "00" "50"),  # invalid type byte
+    bytes.fromhex("cbd10200" "00" "40ffffffffffffffffffff01"),  # varint over 64 bits
+    bytes.fromhex("cbd10200" "00" "8102" "c000" "c201"),  # undefined back-reference
+])
+def test_validate_rejects_malformed(binary):
+    with pytest.raises(ValueError):
+        CBD.validate(binary)
+
+@pytest.mark.parametrize("wrap", [bytes, bytearray, lambda b: memoryview(bytearray(b))])
+def test_validate_utf8(wrap):
+    binary = wrap(bytes.fromhex("cbd10200" "00" "6002" "c328"))
+    CBD.validate(binary)
+    with pytest.raises(ValueError):
+        CBD.validate(binary, check_utf8=True)
+
+def test_validate_limits():
+    binary = CBD.serialize({"a": [[[1]]], "b": "x" * 50})
+    CBD.validate(binary, max_depth=4, max_length=50, max_size=len(binary))
+    with pytest.raises(ValueError):
+        CBD.validate(binary, max_depth=3)
+    with pytest.raises(ValueError):
+        CBD.validate(binary, max_length=49)
+    with pytest.raises(ValueError):
+        CBD.validate(binary, max_size=len(binary) - 1)
+
+def test_validate_max_elements():
+    # Each shared value is an array of two references to the previous one,
+    # so 164 bytes decode to about 8 million elements
+    binary = bytearray.fromhex("cbd10200" "00" "8117" "c04001")
+    for i in range(22):
+        binary += bytes([0xC0, 0x81, 0x02, 0xC2, i, 0xC2, i])
+    CBD.validate(bytes(binary), max_depth=10, max_length=1000, max_size=1000)
+    with pytest.raises(ValueError):
+        CBD.validate(bytes(binary), max_depth=10, max_length=1000, max_size=1000, max_elements=100000)
+    
+    data = CBD.serialize(DOCUMENT, dedup=True)
+    CBD.validate(data, max_elements=34)
+    with pytest.raises(ValueError):
+        CBD.validate(data, max_elements=33)
+
+def test_checksum_detects_corruption():
+    binary = bytearray(CBD.serialize(DOCUMENT, checksum=True))
+    binary[-10] ^= 0x01
+    with pytest.raises(ValueError):
+        CBD.validate(bytes(binary))
+    with pytest.raises(ValueError):
+        CBD.deserialize(bytes(binary))
+
+@pytest.mark.parametrize("new", [
+    {"people": [], "active": False},  # array shrinks, scalar changes, key removed
+    dict(DOCUMENT, status="new", empty=[[], {}, {"added": [1]}]),  # new keys
+    dict(DOCUMENT, people=DOCUMENT["people"][1:] + [{"name": "Ann"}]),  # splice
+    [1, 2, 3],  # root replaced
+])
+def test_diff_apply(new):
+    base = copy.deepcopy(DOCUMENT)
+    patch = CBD.diff(base, new)
+    assert CBD.apply(base, patch) == new
+    assert base == DOCUMENT
+
+def test_diff_is_compact():
+    base = {"items": [{"id": i, "name": f"item{i}", "count": i} for i in range(100)]}
+    new = copy.deepcopy(base)
+    new["items"][42]["count"] = 7
+    assert len(CBD.diff(base, new)) < len(CBD.serialize(new)) // 50
+
+@pytest.mark.parametrize("in_place", [False, True])
+def test_apply_aliased_base(in_place):
+    address = {"city": "X"}
+    base = {"home": address, "billing": address}
+    new = {"home": {"city": "X"}, "billing": {"city": "Y"}}
+    patch = CBD.diff(base, new)
+    assert CBD.apply(base, patch, in_place=in_place) == new
+    assert address == {"city": "X"}
+
+def test_apply_wrong_base():
+    patch = CBD.diff(DOCUMENT, dict(DOCUMENT, active=False))
+    with pytest.raises(ValueError):
+        CBD.apply({"other": 1}, patch)
+
+def test_delta_producer_consumer():
+    producer = DeltaProducer(keyframe_interval=4)
+    consumer = DeltaConsumer()
+    document = copy.deepcopy(DOCUMENT)
+    for version in range(1, 10):
+        document["people"][0]["name"] = f"John {version}"
+        assert consumer.decode(producer.encode(document)) == document
+        assert consumer.version == version
+
+@pytest.mark.parametrize("versions", [
+    [{"a": 1, "c": 3}, {"a": 1, "b": 2, "c": 3}, {"a": 1, "b": 20, "c": 3}],  # key inserted mid-object
+    [{"x": 1, "y": 2}, {"y": 2, "x": 1}, {"y": 5, "x": 1}],  # keys reordered
+])
+def test_delta_key_order(versions):
+    producer = DeltaProducer()
+    consumer = DeltaConsumer()
+    for document in versions:
+        assert consumer.decode(producer.encode(document)) == document
+
+def test_delta_aliased_documents():
+    address = {"city": "X"}
+    producer = DeltaProducer()
+    consumer = DeltaConsumer()
+    for document in [
+        {"home": address, "billing": address},
+        {"home": address, "billing": {"city": "Y"}},
+        {"home": {"city": "Y"}, "billing": {"city": "Y"}},
+    ]:
+        assert consumer.decode(producer.encode(document)) == document
+
+def test_delta_consumer_missed_message():
+    producer = DeltaProducer()
+    consumer = DeltaConsumer()
+    consumer.decode(producer.encode({"count": 1}))
+    producer.encode({"count": 2})  # lost in transit
+    with pytest.raises(ValueError):
+        consumer.decode(producer.encode({"count": 3}))
+    
+    # Resynchronise with a full document
+    producer.reset()
+    assert consumer.decode(producer.encode({"count": 4})) == {"count": 4}
+
+@pytest.mark.parametrize("options", [{}, {"dedup": True}, {"key_index": True}, {"checksum": True}])
+def test_view(options):
+    binary = CBD.serialize(DOCUMENT, **options)
+    view = CBD.view(memoryview(binary))
+    assert isinstance(view, CBDView)
+    assert len(view) == 3 and "active" in view
+    assert view["people"][1]["billing"]["tags"][0] == "home"
+    assert view["people"][0]["address"].decode() == ADDRESS
+    assert view.get("missing") is None
+    assert view.decode() == DOCUMENT
+
+def test_view_scalar_root():
+    assert CBD.view(CBD.serialize("text")) == "text"
+
+def test_shared_memory_pool():
+    with SharedMemoryPool(min_size=1024) as pool:
+        with pool.put(DOCUMENT, dedup=True) as descriptor:
+            assert SharedMemoryPool.load(descriptor) == DOCUMENT
+            with SharedMemoryPool.view(descriptor) as view:
+                assert view["people"][0]["name"] == "John"
+            with pytest.raises(ValueError):
+                view["active"]
+            name = descriptor.name
+        
+        # Released segments are reused for the next document
+        lease = pool.put({"count": 1}, encoder=CBDEncoder())
+        assert lease.descriptor.name == name
+        assert SharedMemoryPool.load(lease.descriptor) == {"count": 1}
+        lease.release()
+        lease.release()
+        with pytest.raises(ValueError):
+            pool.release(lease.descriptor)
+
+@pytest.mark.skipif(not Path("/proc/self/maps").exists(), reason="requires /proc/self/maps")
+@pytest.mark.parametrize("options", [{}, {"key_index": True}, {"checksum": True}])
+def test_shared_memory_consumers_unmap(options):
+    with SharedMemoryPool(min_size=1024, max_idle=1) as pool:
+        names = set()
+        for size in range(1, 40):
+            with pool.put({"items": ["x" * 100] * size}, **options) as descriptor:
+                names.add(descriptor.name)
+                assert len(SharedMemoryPool.load(descriptor)["items"]) == size
+                with SharedMemoryPool.view(descriptor) as view:
+                    assert view["items"][0] == "x" * 100
+    maps = Path("/proc/self/maps").read_text()
+    assert not [name for name in names if name in maps]
+
+def _load_shared(descriptor):
+    return SharedMemoryPool.load(descriptor)
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="requires fork")
+def test_shared_memory_across_processes():
+    with SharedMemoryPool() as pool, pool.put(DOCUMENT) as descriptor:
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(2, mp_context=context) as executor:
+            assert list(executor.map(_load_shared, [descriptor] * 4)) == [DOCUMENT] * 4
+
+@pytest.mark.parametrize("options", [{}, {"key_index": True}, {"checksum": True}])
+def test_encoder_matches_serialize(options):
+    encoder = CBDEncoder(**options)
+    decoder = CBDDecoder()
+    for data in [DOCUMENT, {"people": []}, "text", DOCUMENT]:
+        binary = encoder.encode(data)
+        assert binary == CBD.serialize(data, **options)
+        assert decoder.decode(binary) == data
+
+def test_encode_into_decode_from():
+    encoder = CBDEncoder(checksum=True)
+    decoder = CBDDecoder()
+    buffer = bytearray(1024)
+    first = encoder.encode_into(DOCUMENT, buffer, 4)
+    second = encoder.encode_into({"count": 1}, buffer, 4 + first)
+    
+    view = memoryview(buffer)
+    value, offset = decoder.decode_from(view, 4)
+    assert value == DOCUMENT and offset == 4 + first
+    assert decoder.decode_from(view, offset) == ({"count": 1}, offset + second)
+    
+    with pytest.raises(ValueError):
+        encoder.encode_into(DOCUMENT, bytearray(8))
+
+def test_decoder_reuses_recent_dictionaries():
+    decoder = CBDDecoder(max_shapes=2)
+    messages = [CBD.serialize({name: 1}) for name in ("first", "second", "third")]
+    key = next(iter(decoder.decode(messages[0])))
+    decoder.decode(messages[1])
+    decoder.decode_from(memoryview(messages[0]))
+    decoder.decode(messages[2])
+    # Still cached: the hit made it the most recently used dictionary
+    assert next(iter(decoder.decode(messages[0]))) is key
+
+@pytest.mark.parametrize("options", [{}, {"checksum": True}])
+def test_decoder_other_buffers(options):
+    binary = CBD.serialize(DOCUMENT, **options)
+    decoder = CBDDecoder()
+    with mmap.mmap(-1, len(binary)) as mapped:
+        mapped.write(binary)
+        for buffer in [array.array("B", binary), mapped, array.array("B", binary), mapped]:
+            assert decoder.decode(buffer) == DOCUMENT
+
+def test_decode_from_truncated_checksum():
+    binary = CBD.serialize({"count": 1}, checksum=True)
+    keys_end = CBD._read_header(binary, verify=False)[2]
+    with pytest.raises(ValueError):
+        CBDDecoder().decode_from(binary[:keys_end + 4])
+
+def test_pool():
+    pool = CBDPool(CBDEncoder, key_index=True)
+    with pool.borrow() as encoder:
+        assert encoder.key_index
+        encoder.encode(DOCUMENT)
+    with pool.borrow() as again:
+        assert again is encoder
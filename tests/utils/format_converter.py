@@ -1,8 +1,6 @@
+import importlib
+import importlib.util
 import json
-import msgpack
-import bson
-import orjson
-import ujson
 from pathlib import Path
 import sys
 
@@ -10,152 +8,197 @@ import sys
 sys.path.append(str(Path(__file__).parent.parent.parent))
 from cbd import CBD
 
+class CodecUnavailableError(ImportError):
+    """Raised when a registered format's backing library is not installed."""
+
+class Codec:
+    """A serialization backend whose library is imported on first use.
+    
+    ``loads`` and ``dumps`` are called with the imported module (``None`` for
+    codecs without one) followed by the data to convert.
+    """
+    
+    def __init__(self, name, loads, dumps, module=None, binary=True):
+        self.name = name
+        self.module_name = module
+        self.binary = binary
+        self._loads = loads
+        self._dumps = dumps
+        self._module = None
+    
+    @property
+    def module(self):
+        """Import the backing library the first time it is needed."""
+        if self._module is None and self.module_name is not None:
+            try:
+                self._module = importlib.import_module(self.module_name)
+            except ImportError as e:
+                raise CodecUnavailableError(
+                    f"Format '{self.name}' requires the '{self.module_name}' package"
+                ) from e
+        return self._module
+    
+    def is_available(self):
+        """Check whether the backing library is installed, without importing it."""
+        if self._module is not None or self.module_name is None:
+            return True
+        return importlib.util.find_spec(self.module_name) is not None
+    
+    def loads(self, data):
+        """Decode serialized data to a Python object."""
+        return self._loads(self.module, data)
+    
+    def dumps(self, data):
+        """Encode a Python object; returns bytes for binary codecs, str otherwise."""
+        return self._dumps(self.module, data)
+
+_CODECS = {}
+
+def register_codec(name, loads, dumps, module=None, binary=True):
+    """Register a format with the converter and the command-line interface.
+    
+    ``module`` names the library backing the format; it is only imported when
+    the format is first used. Third-party formats register the same way as the
+    built-in ones::
+    
+        register_codec('yaml', lambda m, s: m.safe_load(s),
+                       lambda m, d: m.safe_dump(d), module='yaml', binary=False)
+    """
+    codec = Codec(name, loads, dumps, module=module, binary=binary)
+    _CODECS[name] = codec
+    return codec
+
+def unregister_codec(name):
+    """Remove a previously registered format."""
+    _CODECS.pop(name, None)
+
+def get_codec(name):
+    """Look up a registered format by name."""
+    try:
+        return _CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unsupported format: {name}") from None
+
+def registered_formats():
+    """Names of all registered formats, in registration order."""
+    return list(_CODECS)
+
+def available_formats():
+    """Names of registered formats whose backing library is installed."""
+    return [name for name, codec in _CODECS.items() if codec.is_available()]
+
+register_codec('json', lambda m, s: json.loads(s), lambda m, d: json.dumps(d), binary=False)
+register_codec('msgpack', lambda m, b: m.unpackb(b), lambda m, d: m.packb(d), module='msgpack')
+register_codec('bson', lambda m, b: m.loads(b), lambda m, d: m.dumps(d), module='bson')
+register_codec('orjson', lambda m, b: m.loads(b), lambda m, d: m.dumps(d), module='orjson')
+register_codec('ujson', lambda m, s: m.loads(s), lambda m, d: m.dumps(d), module='ujson', binary=False)
+register_codec('cbd', lambda m, b: CBD.deserialize(b), lambda m, d: CBD.serialize(d))
+
 class FormatConverter:
+    register_codec = staticmethod(register_codec)
+    
+    @staticmethod
+    def _to_cbd(fmt, data):
+        """Convert ``data`` in format ``fmt`` to CBD; already-decoded objects pass straight through."""
+        codec = get_codec(fmt)
+        if isinstance(data, bytes if codec.binary else str):
+            data = codec.loads(data)
+        return CBD.serialize(data)
+    
+    @staticmethod
+    def _from_cbd(fmt, cbd_data):
+        """Convert CBD data to format ``fmt``."""
+        return get_codec(fmt).dumps(CBD.deserialize(cbd_data))
+    
     @staticmethod
     def json_to_cbd(json_data):
         """Convert JSON data to CBD format."""
-        if isinstance(json_data, str):
-            json_data = json.loads(json_data)
-        return CBD.serialize(json_data)
+        return FormatConverter._to_cbd('json', json_data)
     
     @staticmethod
     def cbd_to_json(cbd_data):
         """Convert CBD data to JSON format."""
-        data = CBD.deserialize(cbd_data)
-        return json.dumps(data)
+        return FormatConverter._from_cbd('json', cbd_data)
     
     @staticmethod
     def msgpack_to_cbd(msgpack_data):
         """Convert MessagePack data to CBD format."""
-        if isinstance(msgpack_data, bytes):
-            data = msgpack.unpackb(msgpack_data)
-        else:
-            data = msgpack_data
-        return CBD.serialize(data)
+        return FormatConverter._to_cbd('msgpack', msgpack_data)
     
     @staticmethod
     def cbd_to_msgpack(cbd_data):
         """Convert CBD data to MessagePack format."""
-        data = CBD.deserialize(cbd_data)
-        return msgpack.packb(data)
+        return FormatConverter._from_cbd('msgpack', cbd_data)
     
     @staticmethod
     def bson_to_cbd(bson_data):
         """Convert BSON data to CBD format."""
-        if isinstance(bson_data, bytes):
-            data = bson.loads(bson_data)
-        else:
-            data = bson_data
-        return CBD.serialize(data)
+        return FormatConverter._to_cbd('bson', bson_data)
     
     @staticmethod
     def cbd_to_bson(cbd_data):
         """Convert CBD data to BSON format."""
-        data = CBD.deserialize(cbd_data)
-        return bson.dumps(data)
+        return FormatConverter._from_cbd('bson', cbd_data)
     
     @staticmethod
     def orjson_to_cbd(orjson_data):
         """Convert orjson data to CBD format."""
-        if isinstance(orjson_data, bytes):
-            data = orjson.loads(orjson_data)
-        else:
-            data = orjson_data
-        return CBD.serialize(data)
+        return FormatConverter._to_cbd('orjson', orjson_data)
     
     @staticmethod
     def cbd_to_orjson(cbd_data):
         """Convert CBD data to orjson format."""
-        data = CBD.deserialize(cbd_data)
-        return orjson.dumps(data)
+        return FormatConverter._from_cbd('orjson', cbd_data)
     
     @staticmethod
     def ujson_to_cbd(ujson_data):
         """Convert ujson data to CBD format."""
-        if isinstance(ujson_data, str):
-            data = ujson.loads(ujson_data)
-        else:
-            data = ujson_data
-        return CBD.serialize(data)
+        return FormatConverter._to_cbd('ujson', ujson_data)
     
     @staticmethod
     def cbd_to_ujson(cbd_data):
         """Convert CBD data to ujson format."""
-        data = CBD.deserialize(cbd_data)
-        return ujson.dumps(data)
+        return FormatConverter._from_cbd('ujson', cbd_data)
     
     @staticmethod
     def convert_file(input_file, output_file, input_format, output_format):
         """Convert a file from one format to another."""
+        # Resolve both formats before touching the filesystem
+        try:
+            reader = get_codec(input_format)
+        except ValueError:
+            raise ValueError(f"Unsupported input format: {input_format}") from None
+        try:
+            writer = get_codec(output_format)
+        except ValueError:
+            raise ValueError(f"Unsupported output format: {output_format}") from None
+        
         # Read input file
-        with open(input_file, 'rb' if input_format in ['cbd', 'msgpack', 'bson'] else 'r') as f:
+        with open(input_file, 'rb' if reader.binary else 'r') as f:
             input_data = f.read()
         
         # Convert data
-        if input_format == 'json':
-            data = json.loads(input_data)
-        elif input_format == 'msgpack':
-            data = msgpack.unpackb(input_data)
-        elif input_format == 'bson':
-            data = bson.loads(input_data)
-        elif input_format == 'orjson':
-            data = orjson.loads(input_data)
-        elif input_format == 'ujson':
-            data = ujson.loads(input_data)
-        elif input_format == 'cbd':
-            data = CBD.deserialize(input_data)
-        else:
-            raise ValueError(f"Unsupported input format: {input_format}")
-        
-        # Convert to output format
-        if output_format == 'json':
-            output_data = json.dumps(data)
-            mode = 'w'
-        elif output_format == 'msgpack':
-            output_data = msgpack.packb(data)
-            mode = 'wb'
-        elif output_format == 'bson':
-            output_data = bson.dumps(data)
-            mode = 'wb'
-        elif output_format == 'orjson':
-            output_data = orjson.dumps(data)
-            mode = 'wb'
-        elif output_format == 'ujson':
-            output_data = ujson.dumps(data)
-            mode = 'w'
-        elif output_format == 'cbd':
-            output_data = CBD.serialize(data)
-            mode = 'wb'
-        else:
-            raise ValueError(f"Unsupported output format: {output_format}")
+        output_data = writer.dumps(reader.loads(input_data))
         
         # Write output file
-        with open(output_file, mode) as f:
+        with open(output_file, 'wb' if writer.binary else 'w') as f:
             f.write(output_data)
     
     @staticmethod
     def compare_formats(data, formats=None):
-        """Compare the size of data in different formats."""
+        """Compare the size of data in different formats.
+        
+        By default every registered format whose library is installed is
+        compared; formats requested explicitly must be available.
+        """
         if formats is None:
-            formats = ['json', 'msgpack', 'bson', 'orjson', 'ujson', 'cbd']
+            formats = available_formats()
         
         results = {}
         for fmt in formats:
-            if fmt == 'json':
-                serialized = json.dumps(data).encode('utf-8')
-            elif fmt == 'msgpack':
-                serialized = msgpack.packb(data)
-            elif fmt == 'bson':
-                serialized = bson.dumps(data)
-            elif fmt == 'orjson':
-                serialized = orjson.dumps(data)
-            elif fmt == 'ujson':
-                serialized = ujson.dumps(data).encode('utf-8')
-            elif fmt == 'cbd':
-                serialized = CBD.serialize(data)
-            else:
-                raise ValueError(f"Unsupported format: {fmt}")
-            
+            serialized = get_codec(fmt).dumps(data)
+            if isinstance(serialized, str):
+                serialized = serialized.encode('utf-8')
             results[fmt] = len(serialized)
         
         return results
@@ -168,10 +211,10 @@ def main():
     parser.add_argument('input_file', help='Input file path')
     parser.add_argument('output_file', help='Output file path')
     parser.add_argument('--input-format', '-i', required=True,
-                      choices=['json', 'msgpack', 'bson', 'orjson', 'ujson', 'cbd'],
+                      choices=registered_formats(),
                       help='Input file format')
     parser.add_argument('--output-format', '-o', required=True,
-                      choices=['json', 'msgpack', 'bson', 'orjson', 'ujson', 'cbd'],
+                      choices=registered_formats(),
                       help='Output file format')
     
     args = parser.parse_args()
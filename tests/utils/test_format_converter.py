@@ -8,7 +8,13 @@ from pathlib import Path
 import tempfile
 import os
 
-from .format_converter import FormatConverter
+from .format_converter import (
+    CodecUnavailableError,
+    FormatConverter,
+    available_formats,
+    register_codec,
+    unregister_codec,
+)
 
 # Test data
 TEST_DATA = {
@@ -126,4 +132,39 @@ def test_invalid_output_format():
 
 def test_nonexistent_input_file():
     with pytest.raises(FileNotFoundError):
-        FormatConverter.convert_file('nonexistent.json', 'output.cbd', 'json', 'cbd') 
\ No newline at end of file
+        FormatConverter.convert_file('nonexistent.json', 'output.cbd', 'json', 'cbd')
+
+def test_register_custom_codec():
+    register_codec('repr', lambda m, s: m.literal_eval(s), lambda m, d: repr(d),
+                   module='ast', binary=False)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_file = os.path.join(temp_dir, 'input.repr')
+            output_file = os.path.join(temp_dir, 'output.cbd')
+            
+            with open(input_file, 'w') as f:
+                f.write(repr({"key": "value", "items": [1, 2, 3]}))
+            
+            # Round-trip through CBD using the third-party format
+            FormatConverter.convert_file(input_file, output_file, 'repr', 'cbd')
+            output_repr = os.path.join(temp_dir, 'output.repr')
+            FormatConverter.convert_file(output_file, output_repr, 'cbd', 'repr')
+            
+            with open(output_repr, 'r') as f:
+                assert f.read() == repr({"key": "value", "items": [1, 2, 3]})
+        
+        assert 'repr' in FormatConverter.compare_formats(TEST_DATA)
+    finally:
+        unregister_codec('repr')
+
+def test_missing_codec_library():
+    register_codec('missing', lambda m, b: m.loads(b), lambda m, d: m.dumps(d),
+                   module='cbd_nonexistent_backend')
+    try:
+        # Unavailable formats are skipped by default but fail loudly when requested
+        assert 'missing' not in available_formats()
+        assert 'missing' not in FormatConverter.compare_formats(TEST_DATA)
+        with pytest.raises(CodecUnavailableError):
+            FormatConverter.compare_formats(TEST_DATA, formats=['missing'])
+    finally:
+        unregister_codec('missing')